@@ -11,11 +11,19 @@ Usage:
 Options:
     -i, --input              Input directory path
     -o, --output             Output directory path
+    --trimmer                Read trimmer: trimmomatic, bbduk or fastp (default: trimmomatic)
     --trimmomatic_path       Path to the Trimmomatic executable or JAR
     --adapters_path          Path to the adapters file for Trimmomatic
     --prokka_db_path         Path to the Prokka database
     --min_contig_length      Minimum contig length (default: 1000)
+    -t, --threads            Number of CPUs each stage may use (default: all CPUs)
+    --scratch_dir            Fast scratch directory to decompress raw reads into once
+    --prokka_profile         Prokka annotation depth: full, fast or noanno (default: full)
+    --preload_db             Read the Prokka database into the page cache before annotation
+    --force                  Re-run every sample, ignoring completed-step markers
+    -c, --config             YAML config file with default paths
     --check                  Check if all dependencies are installed
+    --dry_run                Validate inputs, print the stage arguments and exit
     -v, --version            Show the pipeline version number and exit
     -h, --help               Show this help message and exit
 """
@@ -24,75 +32,334 @@ import subprocess
 import sys
 import os
 import logging
+import logging.handlers
+import queue
+import atexit
 import argparse
-import shutil
+import json
+import fcntl
+from concurrent.futures import ThreadPoolExecutor
 
-script_dir = os.path.dirname(os.path.abspath(__file__))
-src_dir = os.path.join(script_dir, 'src')
-sys.path.append(src_dir)
+src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
 
-from qc import main as qc_main
-from assembly import main as assembly_main
-from annotation import main as annotation_main
+from parallel import split_cpus
+from preflight import build_path_index, find_tool
 
 VERSION = "1.0.0"  # Set your pipeline version here
 
+# Flag each tool prints its version with; anything not listed gets --version.
+TOOL_VERSION_FLAGS = {
+    'fastqc': '--version',
+    'java': '-version',
+    'spades.py': '--version',
+    'prokka': '--version',
+    'checkm': '-h',
+    'reformat.sh': '--help',
+    'bbmap.sh': '--help',
+    'bbduk.sh': '--help',
+    'quast': '--version'
+}
+
+# Tools that passed the check, keyed by path and stamped with mtime/size so an
+# upgraded or replaced binary is probed again.
+TOOL_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'HolmGenome', 'tool_check.json')
+# In-memory copy of the cache, read from disk on first use in this process
+_tool_cache = None
+
 def show_version():
     print(f"HolmGenome pipeline version {VERSION}")
 
+_log_listener = None
+
+def _stop_log_listener():
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
 def setup_logging(log_level=logging.INFO, log_file='HolmGenome.log'):
-    logging.basicConfig(
-        filename=log_file,
-        filemode='a',
-        level=log_level,
-        format='%(asctime)s - %(levelname)s - %(message)s'
-    )
+    global _log_listener
+    # Records are handed to a background listener thread through a queue, so
+    # pipeline workers never block on the file or console write themselves.
+    file_handler = logging.FileHandler(log_file, mode='a', delay=True)
+    file_handler.setLevel(log_level)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
     console = logging.StreamHandler()
     console.setLevel(log_level)
     formatter = logging.Formatter('%(levelname)s - %(message)s')
     console.setFormatter(formatter)
-    logging.getLogger().addHandler(console)
 
-def check_tool(tool):
+    # Called again once the output directory is known; swap out the old
+    # listener instead of stacking a second set of handlers.
+    _stop_log_listener()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            root.removeHandler(handler)
+
+    log_queue = queue.Queue(-1)
+    _log_listener = logging.handlers.QueueListener(log_queue, file_handler, console, respect_handler_level=True)
+    _log_listener.start()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(log_level)
+
+atexit.register(_stop_log_listener)
+
+def load_tool_cache(cache_file=TOOL_CACHE_FILE):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def update_tool_cache(entries, cache_file=TOOL_CACHE_FILE):
+    if not entries:
+        return
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, 'a+') as f:
+            # Lock around the read-modify-write so concurrent runs don't clobber each other
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                cache = json.loads(f.read() or '{}')
+            except ValueError:
+                cache = {}
+            cache.update(entries)
+            f.seek(0)
+            f.truncate()
+            json.dump(cache, f, indent=2)
+    except OSError as e:
+        logging.warning(f"Could not update tool check cache {cache_file}: {e}")
+
+def check_tool(tool, cache=None):
+    """
+    Check that a tool is on PATH and executable.
+
+    Returns a (tool_path, stamp) pair to record in the tool cache, or None if
+    the tool was already known to work.
+    """
     tool_name = os.path.basename(tool)
-    tool_path = shutil.which(tool)
+    tool_path = find_tool(tool)
     if tool_path is None:
-        print(f"Error: {tool_name} not found in PATH.")
-        sys.exit(1)
-    if not os.access(tool_path, os.X_OK):
-        print(f"Error: {tool_name} is not executable.")
-        sys.exit(1)
-    commands_to_try = [['--version'], ['-v'], ['-h'], ['--help']]
-    for cmd_args in commands_to_try:
-        try:
-            with open(os.devnull, 'w') as devnull:
-                result = subprocess.run([tool_path] + cmd_args, stdout=devnull, stderr=devnull)
-            if result.returncode in [0,1]:
-                logging.info(f"{tool_name} is installed and accessible.")
-                return
-        except Exception as e:
-            logging.error(f"Error checking {tool_name}: {e}")
-            continue
-    logging.error(f"{tool_name} not functioning as expected.")
-    sys.exit(f"Error: {tool_name} not functioning as expected.")
+        raise RuntimeError(f"{tool_name} not found in PATH or not executable.")
+    st = os.stat(tool_path)
+    stamp = [st.st_mtime_ns, st.st_size]
+    if cache is not None and cache.get(tool_path) == stamp:
+        logging.info(f"{tool_name} is installed and accessible (cached).")
+        return None
+    # PATH lookup plus the executable bit is the real signal; a single
+    # version call is made only to record the version in the log.
+    version_flag = TOOL_VERSION_FLAGS.get(tool_name, '--version')
+    # close_fds=False with an absolute path lets CPython use posix_spawn
+    # rather than fork(), which avoids copying the parent's page tables.
+    try:
+        result = subprocess.run([tool_path, version_flag], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, timeout=5, close_fds=False)
+    except subprocess.TimeoutExpired:
+        logging.info(f"{tool_name} is installed and accessible.")
+        return tool_path, stamp
+    except OSError as e:
+        raise RuntimeError(f"{tool_name} not functioning as expected: {e}")
+    # Many tools exit non-zero for a version flag, but 126/127 come from a
+    # wrapper whose target cannot run (e.g. a broken conda shim) and a
+    # negative code means a signal killed it; neither is cached as working.
+    if result.returncode in (126, 127) or result.returncode < 0:
+        raise RuntimeError(f"{tool_name} not functioning as expected: exit status {result.returncode}")
+    output = result.stdout.decode(errors='replace').strip()
+    version = output.splitlines()[0] if output else 'unknown version'
+    logging.info(f"{tool_name} is installed and accessible ({version}).")
+    return tool_path, stamp
 
 def check_required_tools(tools):
     logging.info('Checking required tools...')
-    for tool in tools:
-        check_tool(tool)
+    global _tool_cache
+    if _tool_cache is None:
+        _tool_cache = load_tool_cache()
+    cache = _tool_cache
+    build_path_index()
+    # The checks are independent and spend their time waiting on child
+    # processes, so run them side by side rather than one after another.
+    with ThreadPoolExecutor(max_workers=max(1, len(tools))) as executor:
+        futures = [executor.submit(check_tool, tool, cache) for tool in tools]
+    checked = {}
+    for future in futures:
+        error = future.exception()
+        if error is not None:
+            logging.error(str(error))
+            sys.exit(f"Error: {error}")
+        if future.result() is not None:
+            tool_path, stamp = future.result()
+            checked[tool_path] = stamp
+    cache.update(checked)
+    update_tool_cache(checked)
     logging.info('All required tools are installed and accessible.')
 
+# config.yaml keys and the command-line options they stand in for
+CONFIG_KEYS = {
+    'input_dir': 'input',
+    'output_dir': 'output',
+    'trimmer': 'trimmer',
+    'trimmomatic_path': 'trimmomatic_path',
+    'adapters_path': 'adapters_path',
+    'prokka_db_path': 'prokka_db_path',
+    'min_contig_length': 'min_contig_length',
+    'threads': 'threads',
+    'scratch_dir': 'scratch_dir',
+    'preload_db': 'preload_db',
+    'prokka_profile': 'prokka_profile'
+}
+
+def load_config(config_file):
+    """
+    Read pipeline defaults from a YAML config file, keyed by option name.
+    """
+    import yaml
+    with open(config_file) as f:
+        try:
+            config = yaml.safe_load(f) or {}
+        except yaml.YAMLError as e:
+            raise ValueError(e)
+    defaults = {}
+    for key, value in config.items():
+        key = key.lstrip('-')
+        if key in CONFIG_KEYS and value is not None:
+            defaults[CONFIG_KEYS[key]] = value
+    return defaults
+
+def build_plan(args):
+    """
+    Resolve the argument list for every pipeline stage up front.
+    """
+    filtered_contigs_dir = os.path.join(args.output, 'Assembly', 'contigs', 'filtered_contigs')
+    if args.trimmer == 'bbduk':
+        trimmer_args = ['--bbduk']
+    elif args.trimmer == 'fastp':
+        trimmer_args = ['--fastp']
+    else:
+        trimmer_args = ['--trimmomatic_path', args.trimmomatic_path]
+    # Trimmed-read FastQC runs in the background for the whole of assembly
+    # and annotation, so it keeps a small share of -t and they get the rest
+    fastqc_threads, main_threads = split_cpus(args.threads)
+    return {
+        # Trimming plus FastQC on the raw reads
+        'qc': [
+            '--input_dir', args.input,
+            '--output_dir', args.output,
+            '--adapters_path', args.adapters_path,
+            '--suffix1', '_R1_001',
+            '--suffix2', '_R2_001',
+            '--threads', str(args.threads),
+            '--mode', 'raw'
+        ] + trimmer_args
+          + (['--scratch_dir', args.scratch_dir] if args.scratch_dir else [])
+          + (['--force'] if args.force else []),
+        # FastQC on the trimmed reads; nothing downstream waits for it, so it
+        # runs alongside assembly and annotation
+        'qc_trimmed': [
+            '--input_dir', os.path.join(args.output, 'Trim_data'),
+            '--output_dir', args.output,
+            '--adapters_path', args.adapters_path,
+            '--threads', str(fastqc_threads),
+            '--mode', 'trim'
+        ] + trimmer_args
+          + (['--force'] if args.force else []),
+        'assembly': [
+            '--output_dir', args.output,
+            '--spades_path', 'spades.py',
+            '--quast_path', 'quast',
+            '--reformat_path', 'reformat.sh',
+            '--minlength', str(args.min_contig_length),
+            '--threads', str(main_threads)
+        ] + (['--force'] if args.force else []),
+        'annotation': [
+            '--filtered_contigs_dir', filtered_contigs_dir,
+            '--output_dir', args.output,
+            '--threads', str(main_threads)
+        ] + (['--force'] if args.force else [])
+          + (['--db_dir', args.prokka_db_path] if args.prokka_db_path else [])
+          + (['--preload_db'] if args.preload_db and args.prokka_db_path else [])
+          + ['--profile', args.prokka_profile]
+    }
+
+def validate_inputs(args):
+    """
+    Return a list of problems with the user-supplied paths, so typos are
+    reported before any tool is launched rather than hours into a run.
+    """
+    problems = []
+    if not os.path.isdir(args.input):
+        problems.append(f"Input directory does not exist: {args.input}")
+    # The Trimmomatic path may reference an environment variable such as
+    # $EBROOTTRIMMOMATIC, which the QC step expands. It is either a JAR file
+    # or a wrapper executable, which may be a bare name found on PATH.
+    trimmomatic_path = os.path.expandvars(args.trimmomatic_path or '')
+    if args.trimmer == 'trimmomatic':
+        if trimmomatic_path.endswith('.jar'):
+            if not os.path.isfile(trimmomatic_path):
+                problems.append(f"Trimmomatic file does not exist: {args.trimmomatic_path}")
+        elif find_tool(trimmomatic_path) is None:
+            problems.append(f"Trimmomatic executable not found or not executable: {args.trimmomatic_path}")
+    if not os.path.isfile(args.adapters_path):
+        problems.append(f"Adapters file does not exist: {args.adapters_path}")
+    if args.prokka_db_path and not os.path.exists(args.prokka_db_path):
+        problems.append(f"Prokka database does not exist: {args.prokka_db_path}")
+    if args.scratch_dir and not os.path.isdir(args.scratch_dir):
+        problems.append(f"Scratch directory does not exist: {args.scratch_dir}")
+    # Each stage checks its own tools too, but only once the stages before
+    # it have finished; catch a missing tool before any work is done
+    tools = ['fastqc', 'spades.py', 'quast', 'bbmap.sh', 'prokka']
+    if args.trimmer == 'bbduk':
+        tools.append('bbduk.sh')
+    elif args.trimmer == 'fastp':
+        tools.append('fastp')
+    elif trimmomatic_path.endswith('.jar'):
+        tools.append('java')
+    for tool in tools:
+        if find_tool(tool) is None:
+            problems.append(f"Required tool not found in PATH: {tool}")
+    return problems
+
+def check_optional_tools(tools):
+    # Tools the pipeline can do without but runs faster or reports more with
+    for tool in tools:
+        if find_tool(tool) is None:
+            logging.warning(f"Optional tool {tool} not found in PATH.")
+        else:
+            logging.info(f"Optional tool {tool} is installed.")
+
 def main():
     parser = argparse.ArgumentParser(description='HolmGenome Pipeline')
     parser.add_argument('-i', '--input', help='Path to the input directory')
     parser.add_argument('-o', '--output', help='Path to the output directory')
+    parser.add_argument('--trimmer', choices=['trimmomatic', 'bbduk', 'fastp'], default='trimmomatic',
+                        help='Read trimmer: trimmomatic, bbduk (adapter and quality trimming in one multithreaded pass) '
+                             'or fastp (R1 and R2 trimmed concurrently in one streaming pass) (default: trimmomatic)')
     parser.add_argument('--trimmomatic_path', help='Path to the Trimmomatic executable or JAR')
     parser.add_argument('--adapters_path', help='Path to the adapters file')
     parser.add_argument('--prokka_db_path', help='Path to the Prokka database')
     parser.add_argument('--min_contig_length', default='1000', help='Minimum contig length (default: 1000)')
+    parser.add_argument('-t', '--threads', default=os.cpu_count() or 1, type=int, help='Number of CPUs each stage may use, split between samples run in parallel (default: all CPUs)')
+    parser.add_argument('--scratch_dir', help='Fast scratch directory (e.g. /dev/shm) to decompress raw reads into once before QC')
+    parser.add_argument('--prokka_profile', choices=['full', 'fast', 'noanno'], default='full',
+                        help='Prokka annotation depth: full, fast (skip BLAST+ against UniProt) or noanno (gene prediction only)')
+    parser.add_argument('--preload_db', action='store_true', help='Read the Prokka database into the page cache before annotation starts')
+    parser.add_argument('--force', action='store_true', help='Re-run trimming, FastQC, assembly and annotation for every sample, ignoring completed-step markers')
+    parser.add_argument('-c', '--config', help='YAML config file with default paths (command-line options take precedence)')
     parser.add_argument('--check', action='store_true', help='Check if all dependencies are installed')
+    parser.add_argument('--dry_run', action='store_true', help='Validate inputs, print the stage arguments and exit without running any tools')
     parser.add_argument('-v', '--version', action='store_true', help='Show the pipeline version number and exit')
 
+
+    # Values from the config file become defaults, so explicit options win
+    args, _ = parser.parse_known_args()
+    if args.config:
+        try:
+            parser.set_defaults(**load_config(args.config))
+        except (OSError, ImportError, ValueError) as e:
+            parser.error(f"could not read config file {args.config}: {e}")
     args = parser.parse_args()
 
     # If --version is specified, show version and exit immediately
@@ -116,23 +383,46 @@ def main():
             'quast'
         ]
         check_required_tools(tools)
+        check_optional_tools(['pigz', 'rapidgzip', 'multiqc', 'bbduk.sh', 'fastp'])
         logging.info("Dependencies check completed successfully.")
         sys.exit(0)
 
-    if not args.input:
-        args.input = input("Enter the input directory: ").strip()
-    if not args.output:
-        args.output = input("Enter the output directory: ").strip()
-    if not args.trimmomatic_path:
-        args.trimmomatic_path = input("Enter the Trimmomatic path: ").strip()
-    if not args.adapters_path:
-        args.adapters_path = input("Enter the adapters file path: ").strip()
-    if not args.prokka_db_path:
-        args.prokka_db_path = input("Enter the Prokka database path: ").strip()
+    # Pipeline stages are imported only once we know they will run, so
+    # --version and --check don't pay for loading them.
+    from qc import main as qc_main, run_multiqc, SubprocessError
+    from assembly import main as assembly_main
+    from annotation import main as annotation_main
 
-    if not os.path.isdir(args.input):
-        print(f"Error: Input directory does not exist: {args.input}")
+    # Prompt for anything still missing, but only when someone is there to
+    # answer; under a batch scheduler stdin is closed and input() would hang.
+    prompts = [
+        ('input', 'Enter the input directory: '),
+        ('output', 'Enter the output directory: '),
+        ('trimmomatic_path', 'Enter the Trimmomatic path: '),
+        ('adapters_path', 'Enter the adapters file path: '),
+        ('prokka_db_path', 'Enter the Prokka database path: ')
+    ]
+    if args.trimmer != 'trimmomatic':
+        prompts = [(dest, prompt) for dest, prompt in prompts if dest != 'trimmomatic_path']
+    missing = [dest for dest, _ in prompts if not getattr(args, dest)]
+    if missing and not sys.stdin.isatty():
+        options = ', '.join('--' + dest for dest in missing)
+        parser.error(f"missing {options} (required when not running interactively; pass them on the command line or via --config)")
+    for dest, prompt in prompts:
+        if not getattr(args, dest):
+            setattr(args, dest, input(prompt).strip())
+
+    problems = validate_inputs(args)
+    if problems:
+        for problem in problems:
+            print(f"Error: {problem}")
         sys.exit(1)
+
+    plan = build_plan(args)
+    if args.dry_run:
+        print(json.dumps(plan, indent=2))
+        sys.exit(0)
+
     if not os.path.isdir(args.output):
         try:
             os.makedirs(args.output, exist_ok=True)
@@ -146,53 +436,36 @@ def main():
 
     logging.info('Starting HolmGenome pipeline with user-specified arguments.')
 
-    # Run QC on raw data
-    qc_args_raw = [
-        '--input_dir', args.input,
-        '--output_dir', args.output,
-        '--trimmomatic_path', args.trimmomatic_path,
-        '--adapters_path', args.adapters_path,
-        '--suffix1', '_R1_001',
-        '--suffix2', '_R2_001'
-    ]
-    logging.info('Starting Quality Control on raw data.')
-    qc_main(qc_args_raw)
-    logging.info('Quality Control on raw data completed successfully.')
-
-    trimmed_data_path = os.path.join(args.output, 'Trim_data')
-    qc_args_trimmed = [
-        '--input_dir', trimmed_data_path,
-        '--output_dir', args.output,
-        '--trimmomatic_path', args.trimmomatic_path,
-        '--adapters_path', args.adapters_path,
-        '--suffix1', '_R1_paired',
-        '--suffix2', '_R2_paired',
-        '--skip_trim'
-    ]
-    logging.info('Starting Quality Control on trimmed reads.')
-    qc_main(qc_args_trimmed)
-    logging.info('Quality Control on trimmed reads completed successfully.')
-
-    assembly_args = [
-        '--output_dir', args.output,
-        '--spades_path', 'spades.py',
-        '--quast_path', 'quast',
-        '--reformat_path', 'reformat.sh',
-        '--minlength', str(args.min_contig_length)
-    ]
-    logging.info('Starting Assembly step.')
-    assembly_main(assembly_args)
-    logging.info('Assembly step completed successfully.')
+    logging.info('Starting Quality Control.')
+    qc_main(plan['qc'])
+    logging.info('Quality Control completed successfully.')
 
-    filtered_contigs_dir = os.path.join(args.output, 'Assembly', 'contigs', 'filtered_contigs')
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        trimmed_qc = executor.submit(qc_main, plan['qc_trimmed'])
 
-    annotation_args = [
-        '--filtered_contigs_dir', filtered_contigs_dir,
-        '--output_dir', args.output
-    ]
-    logging.info('Starting Annotation step.')
-    annotation_main(annotation_args)
-    logging.info('Annotation step completed successfully.')
+        logging.info('Starting Assembly step.')
+        assembly_main(plan['assembly'])
+        logging.info('Assembly step completed successfully.')
+
+        logging.info('Starting Annotation step.')
+        annotation_main(plan['annotation'])
+        logging.info('Annotation step completed successfully.')
+
+        trimmed_qc.result()
+        logging.info('FastQC on trimmed reads completed successfully.')
+
+    # A single MultiQC pass over the whole output tree picks up the FastQC,
+    # QUAST and Prokka results of every stage at once.
+    if find_tool('multiqc'):
+        logging.info('Starting MultiQC report.')
+        try:
+            run_multiqc('multiqc', args.output, os.path.join(args.output, 'MultiQC'))
+            logging.info('MultiQC report completed successfully.')
+        except SubprocessError as e:
+            # Every stage has finished by now; a missing report is not worth failing the run
+            logging.warning(f'MultiQC report failed: {e}')
+    else:
+        logging.warning('multiqc not found in PATH; skipping the summary report.')
 
     logging.info('HolmGenome pipeline completed successfully.')
 
@@ -4,19 +4,32 @@ import subprocess
 import logging
 import argparse
 import os
+import shlex
 import sys
 import glob
+import hashlib
+import shutil
+from functools import lru_cache
+
+from checkpoint import is_done, mark_done
+from preflight import require_tools
+from parallel import pool_size, run_parallel, threads_per_job
 
 def setup_logging():
     logging.basicConfig(filename='annotation.log', filemode='a', level=logging.INFO,
                         format='%(asctime)s - %(levelname)s - %(message)s')
 
 def run_subprocess(cmd, log_file):
-    logging.info(f'Running command: {" ".join(cmd)}')
-    with open(log_file, 'a') as f:
-        result = subprocess.run(cmd, stdout=f, stderr=subprocess.STDOUT)
+    logging.info(f'Running command: {shlex.join(cmd)}')
+    # stdin is closed so a tool that prompts fails instead of hanging the run
+    with open(log_file, 'ab') as f:
+        try:
+            result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=f, stderr=subprocess.STDOUT)
+        except OSError as e:
+            logging.error(f'Could not run {cmd[0]}: {e}')
+            sys.exit(f'Error: Could not run {cmd[0]}: {e}')
     if result.returncode != 0:
-        logging.error(f'Command failed: {" ".join(cmd)}')
+        logging.error(f'Command failed: {shlex.join(cmd)}')
         sys.exit(f'Error: Command failed. Check {log_file} for details.')
 
 def run_prokka(fasta_file, output_dir, prefix='annotation', prokka_options=None):
@@ -39,30 +52,203 @@ def run_prokka(fasta_file, output_dir, prefix='annotation', prokka_options=None)
         '--prefix', prefix,
         fasta_file
     ] + prokka_options
-    run_subprocess(cmd, 'prokka_output.log')
+    run_subprocess(cmd, os.path.join(output_dir, 'prokka_output.log'))
+
+def warm_page_cache(db_dir):
+    """
+    Ask the kernel to read every file under db_dir into the page cache ahead
+    of time, so the Prokka runs start on a warm database instead of each one
+    faulting it in from disk.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        logging.warning('posix_fadvise is not available; not preloading the Prokka database.')
+        return
+    n_files = 0
+    for root, _, files in os.walk(db_dir):
+        for name in files:
+            try:
+                fd = os.open(os.path.join(root, name), os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                n_files += 1
+            finally:
+                os.close(fd)
+    logging.info(f'Requested preload of {n_files} Prokka database files from {db_dir}')
+
+# Extra Prokka options for each --profile. fast skips the slow BLAST+ search
+# against UniProt; noanno skips functional annotation altogether but still
+# writes a valid GFF of the predicted features.
+PROKKA_PROFILES = {
+    'full': [],
+    'fast': ['--fast'],
+    'noanno': ['--noanno']
+}
+
+def sanitize_headers(in_fasta, out_fasta, mapping_file):
+    """
+    Copy a FASTA file, renaming every record to contig_<n>.
+
+    SPAdes names such as NODE_1234_length_123456_cov_12.345678 can exceed
+    the 37 characters Prokka accepts for a contig ID, which makes it abort.
+    The original headers are written to mapping_file as a two-column TSV
+    (new ID, original header).
+    """
+    n = 0
+    with open(in_fasta) as fin, open(out_fasta, 'w') as fout, open(mapping_file, 'w') as fmap:
+        for line in fin:
+            if line.startswith('>'):
+                n += 1
+                contig_id = f'contig_{n}'
+                fmap.write(f'{contig_id}\t{line[1:].rstrip()}\n')
+                fout.write(f'>{contig_id}\n')
+            else:
+                fout.write(line)
+
+def prokka_cache_key(fasta_file, sample_name, options):
+    # Prokka names its outputs after the sample, so the name is part of the key
+    digest = hashlib.blake2b(digest_size=16)
+    with open(fasta_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    for item in [sample_name] + list(options):
+        digest.update(str(item).encode() + b'\0')
+    return digest.hexdigest()
+
+@lru_cache(maxsize=None)
+def prokka_version():
+    # Prokka prints its version on stderr
+    try:
+        result = subprocess.run(['prokka', '--version'], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+    except OSError:
+        return 'unknown'
+    return result.stdout.decode(errors='replace').strip()
 
-def annotate_contigs(filtered_contigs_dir, annotation_output_dir):
+@lru_cache(maxsize=None)
+def prokka_db_stamp(db_dir=None):
+    """
+    Digest of the name, size and modification time of every file in the
+    Prokka database, so an updated database (e.g. after prokka --setupdb)
+    gives new cache keys. Without db_dir, Prokka uses the db directory
+    next to its own installation.
+    """
+    if not db_dir:
+        prokka = shutil.which('prokka')
+        if not prokka:
+            return ''
+        db_dir = os.path.join(os.path.dirname(os.path.realpath(prokka)), os.pardir, 'db')
+    digest = hashlib.blake2b(digest_size=16)
+    for root, dirs, files in os.walk(db_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            digest.update(f'{os.path.relpath(path, db_dir)}\0{st.st_size}\0{st.st_mtime_ns}\0'.encode())
+    return digest.hexdigest()
+
+def copy_files(src_dir, dest_dir):
+    # Prokka writes a flat directory; hidden files are checkpoint markers.
+    # Files are copied, not linked, so a later forced re-run that rewrites
+    # them in place cannot change the cached copy.
+    os.makedirs(dest_dir, exist_ok=True)
+    for entry in os.scandir(src_dir):
+        if entry.name.startswith('.') or not entry.is_file():
+            continue
+        shutil.copy(entry.path, os.path.join(dest_dir, entry.name))
+
+def annotate_sample(fasta_file, annotation_output_dir, cpus=4, force=False, db_dir=None, extra_options=(),
+                    cache_dir=None):
+    sample_name = os.path.splitext(os.path.basename(fasta_file))[0]
+    sample_output_dir = os.path.join(annotation_output_dir, sample_name)
+    os.makedirs(sample_output_dir, exist_ok=True)
+    # A different profile or database changes the output, so both are part
+    # of the checkpoint
+    params = list(extra_options) + [db_dir]
+    if not force and is_done(sample_output_dir, 'prokka', [fasta_file], params):
+        return
+    # With a cache, an annotation of the same contigs with the same options
+    # from any earlier run (e.g. of a parameter sweep) is reused. The cache
+    # outlives upgrades, so the Prokka version and database are keyed too.
+    cached = None
+    if cache_dir:
+        key_params = params + [prokka_version(), prokka_db_stamp(db_dir)]
+        cached = os.path.join(cache_dir, prokka_cache_key(fasta_file, sample_name, key_params))
+        if not force and os.path.isdir(cached):
+            logging.info(f'Reusing cached Prokka annotation {cached} for {sample_name}')
+            copy_files(cached, sample_output_dir)
+            mark_done(sample_output_dir, 'prokka', [fasta_file], params)
+            return
+    prokka_input = os.path.join(sample_output_dir, f'{sample_name}.input.fasta')
+    sanitize_headers(fasta_file, prokka_input, os.path.join(sample_output_dir, f'{sample_name}.contig_ids.tsv'))
+    prokka_options = ['--cpus', str(cpus)] + list(extra_options)
+    if db_dir:
+        prokka_options += ['--dbdir', db_dir]
+    run_prokka(prokka_input, sample_output_dir, prefix=sample_name, prokka_options=prokka_options)
+    mark_done(sample_output_dir, 'prokka', [fasta_file], params)
+    if cached:
+        # Fill a private directory and rename it into place, so a concurrent
+        # run never sees a half-written cache entry
+        staging = f'{cached}.{os.getpid()}.tmp'
+        copy_files(sample_output_dir, staging)
+        try:
+            os.rename(staging, cached)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+
+def annotate_contigs(filtered_contigs_dir, annotation_output_dir, cpus=4, force=False, db_dir=None, jobs=None,
+                     extra_options=(), cache_dir=None, threads=None):
     """
     Annotate all contig files in the filtered contigs directory using Prokka.
+
+    Each genome gets its own Prokka run so that gene prediction is trained on
+    that genome alone. Each run gets cpus CPUs, and jobs runs go side by side
+    (by default as many as fit in threads CPUs, or all CPUs); cpus=0 runs one
+    genome at a time on every core. db_dir, if given, is passed as Prokka's
+    --dbdir, and extra_options are appended to every run. Samples already
+    annotated from the same contigs and options are skipped unless force is
+    set; with cache_dir, annotations are also shared between runs with
+    different output directories.
     """
     os.makedirs(annotation_output_dir, exist_ok=True)
     fasta_files = glob.glob(os.path.join(filtered_contigs_dir, '*.fasta'))
     if not fasta_files:
         logging.warning(f"No FASTA files found in {filtered_contigs_dir} for annotation.")
         return
-    for fasta_file in fasta_files:
-        sample_name = os.path.basename(fasta_file).split('.')[0]
-        sample_output_dir = os.path.join(annotation_output_dir, sample_name)
-        os.makedirs(sample_output_dir, exist_ok=True)
-        run_prokka(fasta_file, sample_output_dir, prefix=sample_name)
+    if jobs is None:
+        jobs = pool_size(len(fasta_files), cpus, threads) if cpus else 1
+    tasks = [(fasta_file, annotation_output_dir, cpus, force, db_dir, extra_options, cache_dir) for fasta_file in fasta_files]
+    run_parallel(annotate_sample, tasks, jobs)
 
 def main(args=None):
     parser = argparse.ArgumentParser(description='Genome Annotation Pipeline')
     parser.add_argument('--filtered_contigs_dir', required=True, help='Path to the filtered contigs directory')
     parser.add_argument('--output_dir', required=True, help='Path to the output directory')
+    parser.add_argument('--force', action='store_true', help='Re-annotate every sample even if it already completed with the same contigs')
+    parser.add_argument('--threads', default=os.cpu_count() or 1, type=int,
+                        help='Total number of CPUs the stage may use, shared by concurrent Prokka runs (default: all CPUs)')
+    parser.add_argument('--cpus', default=None, type=int,
+                        help='Number of CPUs for each Prokka run (0 = all of --threads, one sample at a time; '
+                             'default: --threads split across the genomes, at least 4 each)')
+    parser.add_argument('--jobs', default=None, type=int, help='Number of samples to annotate at once (default: as many as fit the CPUs)')
+    parser.add_argument('--profile', choices=sorted(PROKKA_PROFILES), default='full',
+                        help='full: complete annotation; fast: skip the BLAST+ search against UniProt; '
+                             'noanno: gene prediction only, no functional annotation (default: full)')
+    parser.add_argument('--norrna', action='store_true', help="Don't run rRNA search")
+    parser.add_argument('--notrna', action='store_true', help="Don't run tRNA search")
+    parser.add_argument('--db_dir', default=None, help='Prokka database root folder (passed to Prokka as --dbdir)')
+    parser.add_argument('--cache_dir', default=None,
+                        help='Directory of Prokka results keyed by contig content and options, reused across runs (default: no cache)')
+    parser.add_argument('--preload_db', action='store_true', help='Read the Prokka database into the page cache before annotating')
 
     args = parser.parse_args(args)
 
+    require_tools(parser, ['prokka'])
+
     setup_logging()
 
     # The annotation directory is inferred from output_dir
@@ -81,8 +267,22 @@ def main(args=None):
         logging.warning(f"No FASTA files found in {args.filtered_contigs_dir}. Nothing to annotate.")
         return
 
+    if args.preload_db and args.db_dir:
+        warm_page_cache(args.db_dir)
+
+    if args.cpus is None:
+        args.cpus = threads_per_job(len(fasta_files), cpus=args.threads)
+
+    extra_options = list(PROKKA_PROFILES[args.profile])
+    if args.norrna:
+        extra_options.append('--norrna')
+    if args.notrna:
+        extra_options.append('--notrna')
+
     # Annotate contigs
-    annotate_contigs(args.filtered_contigs_dir, annotation_output_dir)
+    annotate_contigs(args.filtered_contigs_dir, annotation_output_dir, cpus=args.cpus or args.threads, force=args.force,
+                     db_dir=args.db_dir, jobs=args.jobs, extra_options=extra_options, cache_dir=args.cache_dir,
+                     threads=args.threads)
 
 if __name__ == "__main__":
     main()
@@ -5,8 +5,16 @@ import subprocess
 import shutil
 import argparse
 import glob
+import json
 import logging
+import re
+import shlex
 import sys
+import threading
+
+from checkpoint import is_done, mark_done
+from preflight import require_tools
+from parallel import available_memory_gb, pool_size, run_parallel, threads_per_job
 
 def setup_logging():
     logging.basicConfig(
@@ -17,118 +25,278 @@ def setup_logging():
     )
 
 def setup_directories(directories):
+    # The stage's whole directory layout is created here, once, so the
+    # per-sample and per-tool functions below can assume it exists.
     for directory in directories:
         os.makedirs(directory, exist_ok=True)
 
 def run_subprocess(cmd, log_file):
-    logging.info(f'Running command: {" ".join(cmd)}')
+    logging.info(f'Running command: {shlex.join(cmd)}')
     # Create a copy of the environment and remove JAVA_TOOL_OPTIONS if present
     env = os.environ.copy()
     if 'JAVA_TOOL_OPTIONS' in env:
         del env['JAVA_TOOL_OPTIONS']
 
-    with open(log_file, 'a') as f:
-        result = subprocess.run(cmd, stdout=f, stderr=subprocess.STDOUT, env=env)
+    # stdin is closed so a tool that prompts fails instead of hanging the run
+    with open(log_file, 'ab') as f:
+        try:
+            result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=f, stderr=subprocess.STDOUT, env=env)
+        except OSError as e:
+            logging.error(f'Could not run {cmd[0]}: {e}')
+            sys.exit(f'Error: Could not run {cmd[0]}: {e}')
     if result.returncode != 0:
-        logging.error(f'Command failed: {" ".join(cmd)}')
+        logging.error(f'Command failed: {shlex.join(cmd)}')
         sys.exit(f'Error: Command failed. Check {log_file} for details.')
 
+# Trimmed paired read file name from the QC step; captures the sample and mate
+PAIRED_PATTERN = re.compile(r'(?P<sample>.+)_(?P<mate>R[12])_paired\.fastq(?P<gz>\.gz)?')
+
 def pair_fastq_files(trimmed_data_path):
-    # Recursively find all R1 and R2 paired files in subdirectories
-    r1_files = sorted(glob.glob(os.path.join(trimmed_data_path, '**', '*_R1_paired.fastq*'), recursive=True))
+    # One walk over the trimmed data, classifying R1/R2 files as we go.
+    # Hidden directories (e.g. staging or editor leftovers) are skipped.
+    found = {}
+    for root, dirs, files in os.walk(trimmed_data_path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            match = PAIRED_PATTERN.fullmatch(name)
+            if not match:
+                continue
+            key = (root, match.group('sample'))
+            mates = found.setdefault(key, {})
+            # Prefer the gzipped file when both forms are present
+            if match.group('gz') or match.group('mate') not in mates:
+                mates[match.group('mate')] = os.path.join(root, name)
 
     paired_samples = {}
-    for r1_file in r1_files:
-        base_name = os.path.basename(r1_file)
-        sample_name = base_name.replace('_R1_paired.fastq.gz', '').replace('_R1_paired.fastq', '')
-        r2_file_gz = os.path.join(os.path.dirname(r1_file), f"{sample_name}_R2_paired.fastq.gz")
-        r2_file = os.path.join(os.path.dirname(r1_file), f"{sample_name}_R2_paired.fastq")
-        if os.path.exists(r2_file_gz):
-            r2_file = r2_file_gz
-        elif os.path.exists(r2_file):
-            pass
-        else:
-            logging.warning(f"No matching R2 file for {r1_file}. Skipping this sample.")
+    for (root, sample_name), mates in sorted(found.items()):
+        if 'R1' not in mates:
+            continue
+        if 'R2' not in mates:
+            logging.warning(f"No matching R2 file for {mates['R1']}. Skipping this sample.")
             continue
-        paired_samples[sample_name] = {'R1': r1_file, 'R2': r2_file}
+        paired_samples[sample_name] = {'R1': mates['R1'], 'R2': mates['R2']}
     return paired_samples
 
-def run_assembly(paired_samples, assembly_dir, spades_path='spades.py'):
-    all_contigs_dir = os.path.join(assembly_dir, "contigs", "all_contigs")
-    os.makedirs(all_contigs_dir, exist_ok=True)
-
-    for sample_name, files in paired_samples.items():
-        r1_paired_file = files['R1']
-        r2_paired_file = files['R2']
-        sample_output_dir = os.path.join(assembly_dir, "contigs", "samples", sample_name)
-        os.makedirs(sample_output_dir, exist_ok=True)
-        cmd = [
-            spades_path,
-            '--pe1-1', r1_paired_file,
-            '--pe1-2', r2_paired_file,
+# SPAdes outputs worth keeping once an assembly is done, including the final
+# assembly graphs and contig paths used by Bandage and plasmid tools.
+# Everything else in the sample's directory (per-k directories, corrected
+# reads, tmp/) is scratch that is many times the size of the contigs.
+SPADES_KEEP = {'contigs.fasta', 'scaffolds.fasta', 'contigs.paths', 'scaffolds.paths', 'spades.log', 'warnings.log',
+               'params.txt', 'spades_output.log', 'dataset.yaml'}
+SPADES_KEEP_PREFIXES = ('assembly_graph',)
+
+def remove_spades_work(sample_output_dir):
+    for entry in os.scandir(sample_output_dir):
+        # Hidden files include the checkpoint marker
+        if entry.name in SPADES_KEEP or entry.name.startswith(('.',) + SPADES_KEEP_PREFIXES):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            os.remove(entry.path)
+
+def spades_read_options(libraries, sample_output_dir):
+    if len(libraries) == 1:
+        return ['--pe1-1', libraries[0]['R1'], '--pe1-2', libraries[0]['R2']]
+    # Several read pairs go into one paired-end library through a dataset
+    # file; JSON is valid YAML, which is what SPAdes reads.
+    dataset_file = os.path.join(sample_output_dir, 'dataset.yaml')
+    with open(dataset_file, 'w') as f:
+        json.dump([{
+            'orientation': 'fr',
+            'type': 'paired-end',
+            'left reads': [files['R1'] for files in libraries],
+            'right reads': [files['R2'] for files in libraries]
+        }], f, indent=2)
+    return ['--dataset', dataset_file]
+
+def assemble_sample(sample_name, libraries, assembly_dir, all_contigs_dir, spades_path='spades.py', threads=4, force=False,
+                    memory_gb=None, keep_work=False):
+    # libraries is a list of {'R1': ..., 'R2': ...} read pairs assembled together
+    sample_output_dir = os.path.join(assembly_dir, "contigs", "samples", sample_name)
+    os.makedirs(sample_output_dir, exist_ok=True)
+    inputs = [path for files in libraries for path in (files['R1'], files['R2'])]
+    if force or not is_done(sample_output_dir, 'spades', inputs):
+        cmd = [spades_path] + spades_read_options(libraries, sample_output_dir) + [
+            '-t', str(threads),
             '-o', sample_output_dir
         ]
+        if memory_gb:
+            cmd += ['-m', str(memory_gb)]
         run_subprocess(cmd, os.path.join(sample_output_dir, 'spades_output.log'))
-        # Copy the resulting contigs to the all_contigs_dir
-        contigs_src = os.path.join(sample_output_dir, "contigs.fasta")
-        contigs_dest = os.path.join(all_contigs_dir, f"{sample_name}.fasta")
-        if os.path.exists(contigs_src):
+        mark_done(sample_output_dir, 'spades', inputs)
+        if not keep_work:
+            remove_spades_work(sample_output_dir)
+    # Link the resulting contigs into the all_contigs_dir
+    contigs_src = os.path.join(sample_output_dir, "contigs.fasta")
+    contigs_dest = os.path.join(all_contigs_dir, f"{sample_name}.fasta")
+    if os.path.exists(contigs_src):
+        if os.path.exists(contigs_dest):
+            os.remove(contigs_dest)
+        try:
+            os.link(contigs_src, contigs_dest)
+        except OSError:
             shutil.copy(contigs_src, contigs_dest)
-            logging.info(f"Contigs copied for sample {sample_name}")
-        else:
-            logging.warning(f"Contigs file not found for sample {sample_name}")
+        logging.info(f"Contigs copied for sample {sample_name}")
+    else:
+        logging.warning(f"Contigs file not found for sample {sample_name}")
 
-def reformat_contigs(all_contigs_dir, filtered_contigs_dir, minlength=1000, reformat_path='reformat.sh'):
-    contig_files = glob.glob(os.path.join(all_contigs_dir, '*.fasta'))
-    if not contig_files:
-        logging.warning(f"No contig files found in {all_contigs_dir}")
+def filter_min_length(in_path, out_path, minlength):
+    """
+    Copy the records of a FASTA file whose sequence is at least minlength
+    bases long. Returns (kept, total) record counts.
+    """
+    kept = total = 0
+    with open(in_path, 'rb') as fin, open(out_path, 'wb') as fout:
+        def flush(header, seq_lines):
+            nonlocal kept, total
+            if header is None:
+                return
+            total += 1
+            if sum(len(line.rstrip()) for line in seq_lines) >= minlength:
+                kept += 1
+                fout.write(header)
+                fout.writelines(seq_lines)
+
+        header, seq_lines = None, []
+        for line in fin:
+            if line.startswith(b'>'):
+                flush(header, seq_lines)
+                header, seq_lines = line, []
+            else:
+                seq_lines.append(line)
+        flush(header, seq_lines)
+    return kept, total
+
+def bbtools_heap_options(java_heap):
+    # BBTools scripts size the JVM heap from free memory unless told
+    # otherwise, which oversubscribes a node running several samples at once
+    return [f'-Xmx{java_heap}'] if java_heap else []
+
+def reformat_sample(file, filtered_contigs_dir, minlength=1000, reformat_path='reformat.sh', force=False, use_bbtools=False,
+                    java_heap=None):
+    sample_name = os.path.splitext(os.path.basename(file))[0]
+    output_file = os.path.join(filtered_contigs_dir, f"{sample_name}.fasta")
+    step = f"{sample_name}.reformat"
+    if not force and os.path.exists(output_file) and is_done(filtered_contigs_dir, step, [file], [minlength]):
         return
-    os.makedirs(filtered_contigs_dir, exist_ok=True)
-    for file in contig_files:
-        sample_name = os.path.basename(file).split('.')[0]
-        output_file = os.path.join(filtered_contigs_dir, f"{sample_name}.fasta")
-        cmd = [
-            reformat_path,
+    if use_bbtools:
+        cmd = [reformat_path] + bbtools_heap_options(java_heap) + [
             f"in={file}",
             f"out={output_file}",
             f"minlength={minlength}",
             "overwrite=true"
         ]
-        run_subprocess(cmd, 'reformat_output.log')
-        logging.info(f"Reformatted contigs for sample {sample_name}")
+        run_subprocess(cmd, os.path.join(filtered_contigs_dir, f"{sample_name}.reformat.log"))
+    else:
+        kept, total = filter_min_length(file, output_file, minlength)
+        logging.info(f"Kept {kept} of {total} contigs of at least {minlength} bp for sample {sample_name}")
+    mark_done(filtered_contigs_dir, step, [file], [minlength])
+    logging.info(f"Reformatted contigs for sample {sample_name}")
+
+# The pre-filter QUAST run is only a sanity check of the raw assemblies,
+# so it skips plots, the HTML/Icarus reports and the slower metrics.
+QUAST_QUICK_OPTIONS = ['--fast', '--no-plots', '--no-html', '--no-icarus']
 
-def run_quast(contigs_dir, output_dir, quast_path='quast'):
-    contig_files = glob.glob(os.path.join(contigs_dir, '*.fasta'))
+def run_quast(contigs_dir, output_dir, quast_path='quast', threads=None, extra_options=(), force=False):
+    # One QUAST run covers every assembly, so give it the whole CPU budget
+    contig_files = sorted(glob.glob(os.path.join(contigs_dir, '*.fasta')))
     if not contig_files:
         logging.warning(f"No contig files found in {contigs_dir}")
         return
-    os.makedirs(output_dir, exist_ok=True)
-    cmd = [quast_path] + contig_files + ['-o', output_dir]
+    # Adding, removing or changing any assembly invalidates the report
+    if not force and is_done(output_dir, 'quast', contig_files, extra_options):
+        return
+    threads = threads or os.cpu_count() or 1
+    cmd = [quast_path, '-t', str(threads), '-o', output_dir] + list(extra_options) + contig_files
     run_subprocess(cmd, os.path.join(output_dir, 'quast_output.log'))
+    mark_done(output_dir, 'quast', contig_files, extra_options)
     logging.info(f"QUAST analysis completed for contigs in {contigs_dir}")
 
-def run_bbmap(paired_samples, filtered_contigs_dir, coverage_dir, bbmap_path='bbmap.sh'):
-    for sample_name, files in paired_samples.items():
-        r1_paired_file = files['R1']
-        r2_paired_file = files['R2']
-        ref_file = os.path.join(filtered_contigs_dir, f"{sample_name}.fasta")
-        if not os.path.exists(ref_file):
-            logging.warning(f"Reference contigs not found for sample {sample_name}")
-            continue
-        sample_coverage_dir = os.path.join(coverage_dir, sample_name)
-        os.makedirs(sample_coverage_dir, exist_ok=True)
-        cmd = [
-            bbmap_path,
-            f"in1={r1_paired_file}",
-            f"in2={r2_paired_file}",
-            f"ref={ref_file}",
-            f"covstats={os.path.join(sample_coverage_dir, sample_name + '_covstats.txt')}",
-            f"covhist={os.path.join(sample_coverage_dir, sample_name + '_covhist.tsv')}",
-            f"basecov={os.path.join(sample_coverage_dir, sample_name + '_basecov.txt')}",
-            "usejni=t",
-            f"out={os.path.join(sample_coverage_dir, sample_name + '_mapped.bam')}"
-        ]
-        run_subprocess(cmd, os.path.join(sample_coverage_dir, 'bbmap_output.log'))
+def map_sample(sample_name, files, filtered_contigs_dir, coverage_dir, bbmap_path='bbmap.sh', threads=4, force=False,
+               ref_name=None, java_heap=None):
+    # ref_name selects a shared assembly (co-assembly); by default each
+    # sample maps to its own
+    r1_paired_file = files['R1']
+    r2_paired_file = files['R2']
+    ref_file = os.path.join(filtered_contigs_dir, f"{ref_name or sample_name}.fasta")
+    if not os.path.exists(ref_file):
+        logging.warning(f"Reference contigs not found for sample {sample_name}")
+        return
+    sample_coverage_dir = os.path.join(coverage_dir, sample_name)
+    os.makedirs(sample_coverage_dir, exist_ok=True)
+    inputs = [r1_paired_file, r2_paired_file, ref_file]
+    if not force and is_done(sample_coverage_dir, 'bbmap', inputs):
+        return
+    cmd = [bbmap_path] + bbtools_heap_options(java_heap) + [
+        f"in1={r1_paired_file}",
+        f"in2={r2_paired_file}",
+        f"ref={ref_file}",
+        # Build the index in memory instead of writing ./ref/ to disk, which
+        # would clash between samples mapped in parallel.
+        "nodisk=t",
+        f"covstats={os.path.join(sample_coverage_dir, sample_name + '_covstats.txt')}",
+        f"covhist={os.path.join(sample_coverage_dir, sample_name + '_covhist.tsv')}",
+        f"basecov={os.path.join(sample_coverage_dir, sample_name + '_basecov.txt')}",
+        "usejni=t",
+        f"threads={threads}",
+        # Use pigz for the gzipped read inputs when it is installed
+        "unpigz=t",
+        f"out={os.path.join(sample_coverage_dir, sample_name + '_mapped.bam')}"
+    ]
+    run_subprocess(cmd, os.path.join(sample_coverage_dir, 'bbmap_output.log'))
+    mark_done(sample_coverage_dir, 'bbmap', inputs)
+
+def process_sample(sample_name, files, dirs, params):
+    """
+    Run one sample's whole chain: SPAdes, the contig length filter and BBMap.
+
+    Keeping a sample's steps together means its contigs are filtered and
+    mapped while still in the page cache, and a sample that finishes early
+    moves on instead of waiting for every other assembly.
+    """
+    # SPAdes is the memory-hungry step, so only as many run at once as
+    # the memory budget allows; filtering and mapping are not limited.
+    with params['spades_slots']:
+        assemble_sample(sample_name, [files], dirs['assembly'], dirs['all_contigs'], spades_path=params['spades_path'],
+                        threads=params['threads'], force=params['force'], memory_gb=params['per_job_mem_gb'],
+                        keep_work=params['keep_spades_work'])
+    contigs_file = os.path.join(dirs['all_contigs'], f"{sample_name}.fasta")
+    if not os.path.exists(contigs_file):
+        return
+    reformat_sample(contigs_file, dirs['filtered_contigs'], minlength=params['minlength'],
+                    reformat_path=params['reformat_path'], force=params['force'], use_bbtools=params['use_bbtools'],
+                    java_heap=params['java_heap'])
+    map_sample(sample_name, files, dirs['filtered_contigs'], dirs['coverage'], bbmap_path=params['bbmap_path'],
+               threads=params['threads'], force=params['force'], java_heap=params['java_heap'])
+
+def process_samples(paired_samples, dirs, params):
+    tasks = [(sample_name, files, dirs, params) for sample_name, files in paired_samples.items()]
+    run_parallel(process_sample, tasks, pool_size(len(tasks), params['threads'], params['cpus']))
+
+def coassemble_samples(paired_samples, dirs, params, name='coassembly'):
+    """
+    Pool the reads of every sample into a single SPAdes assembly, then map
+    each sample back to it for per-sample coverage. Meant for replicates or
+    closely related samples, where one graph replaces N near-identical ones.
+    """
+    libraries = [paired_samples[sample_name] for sample_name in sorted(paired_samples)]
+    assemble_sample(name, libraries, dirs['assembly'], dirs['all_contigs'], spades_path=params['spades_path'],
+                    threads=params['cpus'], force=params['force'], memory_gb=params['coassembly_mem_gb'],
+                    keep_work=params['keep_spades_work'])
+    contigs_file = os.path.join(dirs['all_contigs'], f"{name}.fasta")
+    if not os.path.exists(contigs_file):
+        return
+    # Nothing else runs during the single filtering step either
+    reformat_sample(contigs_file, dirs['filtered_contigs'], minlength=params['minlength'],
+                    reformat_path=params['reformat_path'], force=params['force'], use_bbtools=params['use_bbtools'],
+                    java_heap=f"{params['coassembly_mem_gb']}g")
+    tasks = [
+        (sample_name, files, dirs['filtered_contigs'], dirs['coverage'], params['bbmap_path'], params['threads'],
+         params['force'], name, params['java_heap'])
+        for sample_name, files in paired_samples.items()
+    ]
+    run_parallel(map_sample, tasks, pool_size(len(tasks), params['threads'], params['cpus']))
 
 def main(args=None):
     parser = argparse.ArgumentParser(description='Genome Assembly Pipeline')
@@ -137,15 +305,38 @@ def main(args=None):
     parser.add_argument('--quast_path', default='quast', help='Path to QUAST executable')
     parser.add_argument('--bbmap_path', default='bbmap.sh', help='Path to BBMap executable')
     parser.add_argument('--minlength', default=1000, type=int, help='Minimum length of contigs to keep')
+    parser.add_argument('--force', action='store_true', help='Re-run every sample even if it already completed with the same inputs')
+    parser.add_argument('--coassembly', action='store_true',
+                        help='Assemble the reads of all samples together and map each sample back to the shared assembly')
+    parser.add_argument('--keep_spades_work', action='store_true',
+                        help='Keep the SPAdes working files (per-k-mer directories, corrected reads) instead of only the final '
+                             'contigs, scaffolds and assembly graphs')
+    parser.add_argument('--per_job_mem_gb', default=None, type=int,
+                        help='Memory limit in GB for each SPAdes run and BBTools Java heap; also caps how many SPAdes runs go at once '
+                             '(default: --max_mem_gb split across the samples run at once, or all of it for the '
+                             'single --coassembly SPAdes run)')
+    parser.add_argument('--max_mem_gb', default=None, type=int,
+                        help='Memory budget in GB shared by concurrent SPAdes and BBTools runs (default: currently available memory)')
+    parser.add_argument('--threads', default=os.cpu_count() or 1, type=int,
+                        help='Total number of CPUs the stage may use, shared by concurrent samples (default: all CPUs)')
+    parser.add_argument('--threads_per_job', default=None, type=int,
+                        help='Threads given to each SPAdes/BBMap run; samples run in parallel to fill the remaining CPUs '
+                             '(default: --threads split across the samples, at least 4 each)')
 
     # Get the directory of this script
     script_dir = os.path.dirname(os.path.abspath(__file__))
     # Set the default reformat_path to the reformat.sh in the src directory
     reformat_default_path = os.path.join(script_dir, 'reformat.sh')
     parser.add_argument('--reformat_path', default=reformat_default_path, help='Path to reformat.sh script')
+    parser.add_argument('--use_bbtools', action='store_true', help='Filter contigs by length with reformat.sh instead of in-process')
 
     args = parser.parse_args(args)
 
+    tools = [args.spades_path, args.quast_path, args.bbmap_path]
+    if args.use_bbtools:
+        tools.append(args.reformat_path)
+    require_tools(parser, tools)
+
     setup_logging()
 
     # Define directories
@@ -184,20 +375,58 @@ def main(args=None):
         logging.error('No paired FASTQ files found. Exiting.')
         sys.exit('Error: No paired FASTQ files found.')
 
-    # Run assembly
-    run_assembly(paired_samples, assembly_dir, spades_path=args.spades_path)
+    dirs = {
+        'assembly': assembly_dir,
+        'all_contigs': all_contigs_dir,
+        'filtered_contigs': filtered_contigs_dir,
+        'coverage': coverage_dir
+    }
+    if args.threads_per_job is None:
+        args.threads_per_job = threads_per_job(len(paired_samples), cpus=args.threads)
+    jobs = pool_size(len(paired_samples), args.threads_per_job, args.threads)
+    logging.info(f'Giving {args.threads_per_job} threads to each of up to {jobs} samples at once')
 
-    # Reformat contigs
-    reformat_contigs(all_contigs_dir, filtered_contigs_dir, minlength=args.minlength, reformat_path=args.reformat_path)
+    # Without a cap, concurrent SPAdes runs and BBTools JVMs each size
+    # themselves from the whole machine's memory and can be OOM-killed
+    max_mem_gb = args.max_mem_gb or available_memory_gb()
+    # A co-assembly is a single SPAdes run over every sample's reads, so by
+    # default it gets the whole budget rather than one sample's share
+    coassembly_mem_gb = args.per_job_mem_gb or max_mem_gb
+    if not args.per_job_mem_gb:
+        args.per_job_mem_gb = max(1, max_mem_gb // jobs)
+    spades_jobs = max(1, max_mem_gb // args.per_job_mem_gb)
+    logging.info(f'Running at most {spades_jobs} SPAdes jobs at once ({args.per_job_mem_gb} GB each of {max_mem_gb} GB)')
+
+    params = {
+        'spades_path': args.spades_path,
+        'reformat_path': args.reformat_path,
+        'bbmap_path': args.bbmap_path,
+        'minlength': args.minlength,
+        'threads': args.threads_per_job,
+        'cpus': args.threads,
+        'force': args.force,
+        'use_bbtools': args.use_bbtools,
+        'per_job_mem_gb': args.per_job_mem_gb,
+        'coassembly_mem_gb': coassembly_mem_gb,
+        'keep_spades_work': args.keep_spades_work,
+        # BBTools jobs share the same per-job memory budget as SPAdes
+        'java_heap': f'{args.per_job_mem_gb}g',
+        'spades_slots': threading.BoundedSemaphore(spades_jobs)
+    }
+
+    if args.coassembly:
+        coassemble_samples(paired_samples, dirs, params)
+    else:
+        # Assemble, filter and map each sample in one go
+        process_samples(paired_samples, dirs, params)
 
     # Run QUAST on all contigs
-    run_quast(all_contigs_dir, pre_quast_dir, quast_path=args.quast_path)
+    run_quast(all_contigs_dir, pre_quast_dir, quast_path=args.quast_path, threads=args.threads,
+              extra_options=QUAST_QUICK_OPTIONS, force=args.force)
 
     # Run QUAST on filtered contigs
-    run_quast(filtered_contigs_dir, filtered_quast_dir, quast_path=args.quast_path)
-
-    # Run BBMap to calculate coverage
-    run_bbmap(paired_samples, filtered_contigs_dir, coverage_dir, bbmap_path=args.bbmap_path)
+    run_quast(filtered_contigs_dir, filtered_quast_dir, quast_path=args.quast_path, threads=args.threads,
+              force=args.force)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Per-sample checkpoint markers so a re-run of the pipeline skips steps whose
+inputs have not changed since they last completed.
+
+A marker is a small file holding a digest of the step's inputs (path, size
+and the first MiB of each file) plus any parameters that affect the output.
+It is written only after the step succeeds, so a step that failed or was
+interrupted is always run again.
+"""
+
+import hashlib
+import logging
+import os
+
+HEAD_BYTES = 1 << 20
+
+def input_digest(input_files, params=()):
+    digest = hashlib.blake2b()
+    for path in input_files:
+        digest.update(os.path.abspath(path).encode())
+        digest.update(str(os.path.getsize(path)).encode())
+        with open(path, 'rb') as f:
+            digest.update(f.read(HEAD_BYTES))
+    for param in params:
+        digest.update(str(param).encode())
+    return digest.hexdigest()
+
+def marker_path(output_dir, step):
+    return os.path.join(output_dir, f'.{step}.done')
+
+def is_done(output_dir, step, input_files, params=()):
+    marker = marker_path(output_dir, step)
+    try:
+        with open(marker) as f:
+            done = f.read().strip() == input_digest(input_files, params)
+    except OSError:
+        return False
+    if done:
+        logging.info(f'Skipping {step} in {output_dir}: already completed with the same inputs')
+    return done
+
+def mark_done(output_dir, step, input_files, params=()):
+    with open(marker_path(output_dir, step), 'w') as f:
+        f.write(input_digest(input_files, params) + '\n')
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Helpers for running independent per-sample tool invocations side by side.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+def pool_size(n_tasks, threads_per_job, cpus=None):
+    # Run as many samples side by side as the CPUs allow at threads_per_job
+    # each; cpus is the stage's CPU budget (default: every CPU)
+    cpus = cpus or os.cpu_count() or 1
+    return max(1, min(n_tasks, cpus // max(1, threads_per_job)))
+
+def threads_per_job(n_tasks, minimum=4, cpus=None):
+    # Split the CPUs evenly when there are only a few samples, so a small
+    # batch still uses the whole machine; larger batches get minimum each
+    cpus = cpus or os.cpu_count() or 1
+    return min(cpus, max(minimum, cpus // max(1, n_tasks)))
+
+def split_cpus(cpus, fraction=8):
+    # Split a CPU budget between a background job (FastQC running alongside
+    # the main work) and the main work: (background, main). FastQC gets
+    # about one CPU in fraction, and at least one; so does the main work.
+    background = max(1, cpus // fraction)
+    return background, max(1, cpus - background)
+
+def run_parallel(func, tasks, max_workers):
+    # Per-sample tool runs are independent and spend their time waiting on the
+    # child process, so threads are enough to overlap them. Results come back
+    # in task order. After the first failure, tasks that have not started are
+    # cancelled instead of running to completion before the error surfaces.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(func, *task) for task in tasks]
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+def available_memory_gb():
+    # MemAvailable counts reclaimable page cache too; fall back to free pages
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // (1 << 20)
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // (1 << 30)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Check that a stage's external tools can be found before any of them is
+started, so a misconfigured path fails at once instead of after the first
+samples have been processed. HolmGenome.py resolves tools through the same
+find_tool, so the pipeline and its stages agree on which binary is used.
+"""
+
+import os
+
+# PATH value the index was built from, and executable name -> candidate paths
+_path_index = (None, {})
+
+def build_path_index():
+    # List every PATH directory once so looking up several tools doesn't stat
+    # each name in every directory; rebuilt only if PATH itself changes.
+    global _path_index
+    path = os.environ.get('PATH', os.defpath)
+    if _path_index[0] != path:
+        index = {}
+        for directory in path.split(os.pathsep):
+            try:
+                with os.scandir(directory or os.curdir) as entries:
+                    for entry in entries:
+                        index.setdefault(entry.name, []).append(entry.path)
+            except OSError:
+                continue
+        _path_index = (path, index)
+    return _path_index[1]
+
+def is_executable(path):
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+def find_tool(tool):
+    """
+    Resolve a tool name like shutil.which does, using the cached PATH index.
+    Returns the first executable regular file of that name on PATH, or None.
+    """
+    if os.path.dirname(tool):
+        return tool if is_executable(tool) else None
+    for candidate in build_path_index().get(tool, []):
+        # A non-executable file of the same name earlier on PATH is skipped
+        if is_executable(candidate):
+            return candidate
+    return None
+
+def require_tools(parser, tools):
+    missing = [tool for tool in tools if find_tool(tool) is None]
+    if missing:
+        parser.error('tools not found or not executable: ' + ', '.join(missing))
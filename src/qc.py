@@ -2,16 +2,26 @@
 
 import argparse
 import os
+import re
+import shlex
 import subprocess
 import logging
-import glob
 import sys
+import shutil
+import tempfile
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from checkpoint import is_done, mark_done
+from parallel import run_parallel, split_cpus
+from preflight import require_tools
 
 def setup_logging():
     logging.basicConfig(filename='trim.log', filemode='a', level=logging.DEBUG,
                         format='%(asctime)s - %(levelname)s - %(message)s')
 
 def setup_directories(base_dir):
+    # Create the stage's whole output layout once up front
     dirs = [
         os.path.join(base_dir, 'Trim_data'),
         os.path.join(base_dir, 'QC', 'raw_data'),
@@ -20,135 +30,461 @@ def setup_directories(base_dir):
     for d in dirs:
         os.makedirs(d, exist_ok=True)
 
+class SubprocessError(RuntimeError):
+    """
+    A tool exited with a non-zero status. Raised instead of exiting so that
+    one bad sample does not stop the samples trimmed alongside it.
+    """
+    def __init__(self, cmd, returncode, log_file):
+        super().__init__(f'Command failed with exit status {returncode}. Check {log_file} for details.')
+        self.cmd = cmd
+        self.returncode = returncode
+        self.log_file = log_file
+
 def run_subprocess(cmd, log_file):
-    logging.info(f'Running command: {cmd}')
-    with open(log_file, 'a') as f:
-        result = subprocess.run(cmd, shell=True, stdout=f, stderr=subprocess.STDOUT)
+    logging.info(f'Running command: {shlex.join(cmd)}')
+    # Heap sizes set through JAVA_TOOL_OPTIONS (e.g. by a cluster module)
+    # would override the ones given on the command line
+    env = os.environ.copy()
+    env.pop('JAVA_TOOL_OPTIONS', None)
+
+    # stdin is closed so a tool that prompts fails instead of hanging the run
+    with open(log_file, 'ab') as f:
+        try:
+            result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=f, stderr=subprocess.STDOUT, env=env)
+        except OSError as e:
+            logging.error(f'Could not run {cmd[0]}: {e}')
+            sys.exit(f'Error: Could not run {cmd[0]}: {e}')
     if result.returncode != 0:
-        logging.error(f'Command failed: {cmd}')
-        sys.exit(f'Error: Command failed. Check {log_file} for details.')
+        logging.error(f'Command failed: {shlex.join(cmd)}')
+        raise SubprocessError(cmd, result.returncode, log_file)
 
-def run_fastqc(fastqc_path, data_dir, output_dir):
-    os.makedirs(output_dir, exist_ok=True)
-    # Search recursively for fastq files
-    fastq_files = glob.glob(os.path.join(data_dir, '**', '*.fastq*'), recursive=True)
+FASTQC_BATCH_SIZE = 500
+
+def fastqc_report(fastq_file, output_dir):
+    # FastQC names its report after the file, minus .gz and then .fastq
+    name = os.path.basename(fastq_file)
+    for ext in ('.gz', '.fastq'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return os.path.join(output_dir, f'{name}_fastqc.zip')
+
+def fastqc_pending(fastq_files, output_dir):
+    # Files with no report yet, or a report older than the file itself
+    pending = []
+    for fastq_file in fastq_files:
+        try:
+            if os.path.getmtime(fastqc_report(fastq_file, output_dir)) > os.path.getmtime(fastq_file):
+                continue
+        except OSError:
+            pass
+        pending.append(fastq_file)
+    return pending
+
+def run_fastqc(fastqc_path, data_dir, output_dir, fastq_files=None, force=False, threads=None):
+    # Search recursively for fastq files, unless the caller already has them
+    if fastq_files is None:
+        fastq_files = [path for _, path in find_fastq_files(data_dir)]
     if not fastq_files:
         logging.warning(f"No FASTQ files found in {data_dir} for FastQC.")
-    for fastq_file in fastq_files:
-        cmd = f'{fastqc_path} -o {output_dir} {fastq_file}'
-        run_subprocess(cmd, 'fastqc_output.log')
+        return
+    if not force:
+        pending = fastqc_pending(fastq_files, output_dir)
+        if len(pending) < len(fastq_files):
+            logging.info(f'Skipping FastQC for {len(fastq_files) - len(pending)} files in {data_dir} '
+                         f'with up-to-date reports in {output_dir}')
+        fastq_files = pending
+    # One FastQC process per batch of files: a single JVM start, with
+    # FastQC's own threads working through the files in parallel. Batching
+    # keeps the command line under the kernel's argument size limit.
+    for i in range(0, len(fastq_files), FASTQC_BATCH_SIZE):
+        batch = fastq_files[i:i + FASTQC_BATCH_SIZE]
+        batch_threads = min(len(batch), threads or os.cpu_count() or 1)
+        cmd = [fastqc_path, '-t', str(batch_threads), '-o', output_dir] + batch
+        run_subprocess(cmd, os.path.join(output_dir, 'fastqc_output.log'))
+
+def run_multiqc(multiqc_path, input_dir, output_dir=None):
+    output_dir = output_dir or input_dir
+    os.makedirs(output_dir, exist_ok=True)
+    cmd = [multiqc_path, '-o', output_dir, input_dir]
+    run_subprocess(cmd, os.path.join(output_dir, 'multiqc_output.log'))
 
-def run_multiqc(multiqc_path, input_dir):
-    os.makedirs(input_dir, exist_ok=True)
-    cmd = f'{multiqc_path} -o {input_dir} {input_dir}'
-    run_subprocess(cmd, 'multiqc_output.log')
+def trimmomatic_command(trimmomatic_path, java_heap=None):
+    # The path may name the JAR through an environment variable such as
+    # $EBROOTTRIMMOMATIC, which used to be expanded by the shell.
+    trimmomatic_path = os.path.expandvars(trimmomatic_path)
+    if trimmomatic_path.endswith('.jar'):
+        java_options = ['-XX:+UseParallelGC']
+        if java_heap:
+            java_options.insert(0, f'-Xmx{java_heap}')
+        return ['java'] + java_options + ['-jar', trimmomatic_path]
+    return [trimmomatic_path]
+
+@contextmanager
+def pigz_outputs(outputs, threads=1):
+    """
+    Yield paths to write uncompressed FASTQ to in place of the .gz outputs;
+    each is a named pipe that a pigz process compresses into the real output.
+    Trimmomatic compresses .gz output on a single thread, which bounds the
+    whole trimming step. Without pigz the outputs are yielded unchanged.
+
+    pigz writes into the same hidden directory as the pipes, and the results
+    are moved to the real outputs only if the trimmer and every pigz process
+    succeeded, so a failed run leaves no valid-looking .gz files behind.
+    """
+    pigz = shutil.which('pigz')
+    if not pigz:
+        yield outputs
+        return
+    fifo_dir = tempfile.mkdtemp(prefix='.holmgenome_pigz_', dir=os.path.dirname(outputs[0]))
+    fifos, partials, writers, procs = [], [], [], []
+    succeeded = False
+    try:
+        for output in outputs:
+            partial = os.path.join(fifo_dir, os.path.basename(output))
+            fifo = partial[:-len('.gz')]
+            os.mkfifo(fifo)
+            read_fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            # Holding a write end open keeps pigz from seeing end-of-file
+            # before the trimmer has opened the pipe, or if it never does
+            writers.append(os.open(fifo, os.O_WRONLY))
+            os.set_blocking(read_fd, True)
+            with open(partial, 'wb') as f:
+                procs.append(subprocess.Popen([pigz, '-p', str(threads), '-c'], stdin=read_fd, stdout=f))
+            os.close(read_fd)
+            fifos.append(fifo)
+            partials.append(partial)
+        yield fifos
+        succeeded = True
+    finally:
+        for fd in writers:
+            os.close(fd)
+        failed = [(proc.args, proc.returncode) for proc in procs if proc.wait() != 0]
+        if succeeded and not failed:
+            for partial, output in zip(partials, outputs):
+                os.replace(partial, output)
+        shutil.rmtree(fifo_dir, ignore_errors=True)
+    if failed:
+        cmd, returncode = failed[0]
+        logging.error(f'Command failed: {shlex.join(cmd)}')
+        raise SubprocessError(cmd, returncode, outputs[0])
 
 def run_trimmomatic(params):
-    cmd = (
-        f"java -jar {params['trimmomatic_path']} PE -phred33 "
-        f"{params['input_file1']} {params['input_file2']} "
-        f"{params['output_file1_paired']} {params['output_file1_unpaired']} "
-        f"{params['output_file2_paired']} {params['output_file2_unpaired']} "
-        f"ILLUMINACLIP:{params['adapters_path']}:{params['illuminaclip']} "
-        f"LEADING:{params['leading']} TRAILING:{params['trailing']} "
-        f"SLIDINGWINDOW:{params['slidingwindow']} MINLEN:{params['minlen']}"
-    )
-    if params['crop']:
-        cmd += f" CROP:{params['crop']}"
-    if params['headcrop']:
-        cmd += f" HEADCROP:{params['headcrop']}"
-    run_subprocess(cmd, 'trimmomatic_output.log')
+    outputs = [
+        params['output_file1_paired'], params['output_file1_unpaired'],
+        params['output_file2_paired'], params['output_file2_unpaired']
+    ]
+    # With pigz, half of the sample's threads go to compression, shared by
+    # the two paired outputs that carry nearly all of the reads
+    pigz_threads = params['threads'] // 2
+    with pigz_outputs(outputs, max(1, pigz_threads // 2)) as targets:
+        trim_threads = params['threads'] if targets == outputs else max(1, params['threads'] - pigz_threads)
+        cmd = trimmomatic_command(params['trimmomatic_path'], params['java_heap']) + [
+            'PE', '-threads', str(trim_threads), '-phred33',
+            params['input_file1'], params['input_file2']
+        ] + targets + [
+            f"ILLUMINACLIP:{params['adapters_path']}:{params['illuminaclip']}",
+            f"LEADING:{params['leading']}", f"TRAILING:{params['trailing']}",
+            f"SLIDINGWINDOW:{params['slidingwindow']}", f"MINLEN:{params['minlen']}"
+        ]
+        if params['crop']:
+            cmd.append(f"CROP:{params['crop']}")
+        if params['headcrop']:
+            cmd.append(f"HEADCROP:{params['headcrop']}")
+        # Each sample logs next to its trimmed reads, so samples never share a log
+        run_subprocess(cmd, os.path.join(os.path.dirname(params['output_file1_paired']), 'trimmomatic_output.log'))
 
 def run_bbduk(params):
-    cmd = (
-        f"{params['bbduk_path']} in1={params['input_file1']} in2={params['input_file2']} "
-        f"out1={params['output_file1']} out2={params['output_file2']} "
-        f"ref={params['adapters_path']} ktrim={params['ktrim']} k={params['k']} "
-        f"mink={params['mink']} hdist={params['hdist']} tpe={params['tpe']} "
-        f"tbo={params['tbo']} qtrim={params['qtrim']} trimq={params['trimq']} "
-        f"minlen={params['minlen']}"
+    cmd = [params['bbduk_path']] + ([f"-Xmx{params['java_heap']}"] if params['java_heap'] else []) + [
+        f"in1={params['input_file1']}", f"in2={params['input_file2']}",
+        f"out1={params['output_file1']}", f"out2={params['output_file2']}",
+        f"ref={params['adapters_path']}", f"ktrim={params['ktrim']}", f"k={params['k']}",
+        f"mink={params['mink']}", f"hdist={params['hdist']}", f"tpe={params['tpe']}",
+        f"tbo={params['tbo']}", f"qtrim={params['qtrim']}", f"trimq={params['trimq']}",
+        f"minlen={params['minlen']}", f"threads={params['threads']}",
+        # Hand gzip (de)compression of the reads to pigz when it is installed
+        "pigz=t", "unpigz=t"
+    ]
+    run_subprocess(cmd, os.path.join(os.path.dirname(params['output_file1']), 'bbduk_output.log'))
+
+# fastp does not use more than this many worker threads
+FASTP_MAX_THREADS = 16
+
+def run_fastp(params):
+    # fastp trims R1 and R2 in one streaming pass, on separate worker threads,
+    # and compresses its output itself
+    output_dir = os.path.dirname(params['output_file1'])
+    cmd = [
+        params['fastp_path'],
+        '-i', params['input_file1'], '-I', params['input_file2'],
+        '-o', params['output_file1'], '-O', params['output_file2'],
+        '--adapter_fasta', params['adapters_path'],
+        '--length_required', str(params['minlen']),
+        '--thread', str(min(params['threads'], FASTP_MAX_THREADS)),
+        '--json', os.path.join(output_dir, f"{params['sample']}.fastp.json"),
+        '--html', os.path.join(output_dir, f"{params['sample']}.fastp.html")
+    ]
+    run_subprocess(cmd, os.path.join(output_dir, 'fastp_output.log'))
+
+FASTQ_EXTENSIONS = ('.fastq.gz', '.fastq')
+
+def find_fastq_files(data_dir):
+    """
+    Return (name, path) for every FASTQ file under data_dir, recursively,
+    sorted by path. Uses os.scandir so each entry's type comes from the
+    directory listing instead of a separate stat call.
+    """
+    fastq_files = []
+    stack = [data_dir]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError as e:
+            logging.warning(f"Could not scan {e.filename}: {e.strerror}")
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(FASTQ_EXTENSIONS) and entry.is_file():
+                    fastq_files.append((entry.name, entry.path))
+    fastq_files.sort(key=lambda f: f[1])
+    return fastq_files
+
+def read_name_pattern(suffix1, suffix2):
+    # <sample><suffix1|suffix2><.fastq|.fastq.gz>, anchored at both ends so the
+    # suffix only counts right before the extension
+    return re.compile(
+        rf'(?P<sample>.+)(?P<suffix>{re.escape(suffix1)}|{re.escape(suffix2)})'
+        rf'(?:{"|".join(re.escape(e) for e in FASTQ_EXTENSIONS)})'
     )
-    run_subprocess(cmd, 'bbduk_output.log')
 
-def pair_fastq_files(input_dir, suffix1, suffix2):
-    # Recursively find files that match the suffixes
-    # Using '**' and recursive=True to handle subdirectories
+def pair_fastq_files(input_dir, suffix1, suffix2, fastq_files=None):
+    # Key each read file by the sample name left after stripping the read
+    # suffix and extension; other files next to the reads are ignored.
+    # fastq_files is a find_fastq_files listing of input_dir to reuse.
+    pattern = read_name_pattern(suffix1, suffix2)
     paired_files = {}
-    # Consider .fastq and .fastq.gz
-    patterns = [f"**/*{suffix1}*.fastq*", f"**/*{suffix2}*.fastq*"]
-    found_files = []
-    for pattern in patterns:
-        found_files.extend(glob.glob(os.path.join(input_dir, pattern), recursive=True))
-    found_files = list(set(found_files))
-    logging.info(f'Found files with suffixes {suffix1}, {suffix2}: {found_files}')
-
-    # Group by sample
-    for file in found_files:
-        base = os.path.basename(file)
-        if suffix1 in base:
-            sample_name = base.replace(suffix1, '').replace('.fastq.gz', '').replace('.fastq','')
-            paired_files.setdefault(sample_name, {})['R1'] = file
-        elif suffix2 in base:
-            sample_name = base.replace(suffix2, '').replace('.fastq.gz', '').replace('.fastq','')
-            paired_files.setdefault(sample_name, {})['R2'] = file
-
-    logging.info(f'Paired files: {paired_files}')
+    if fastq_files is None:
+        fastq_files = find_fastq_files(input_dir)
+    for name, file in fastq_files:
+        match = pattern.fullmatch(name)
+        if not match:
+            continue
+        sample_name = match.group('sample')
+        read = 'R1' if match.group('suffix') == suffix1 else 'R2'
+        sample = paired_files.setdefault(sample_name, {})
+        if read in sample:
+            logging.warning(f'Duplicate {read} file for sample {sample_name}: keeping {sample[read]}, ignoring {file}')
+            continue
+        sample[read] = file
+    logging.info(f'Paired {len(paired_files)} samples in {input_dir}')
+    # The full listing can run to thousands of entries; it is only formatted
+    # when debug logging is on
+    logging.debug('Paired files: %s', paired_files)
     return paired_files
 
-def process_samples(args, paired_files):
+def decompress_command(src, threads=1):
+    # rapidgzip decodes a single gzip stream on many threads; pigz only moves
+    # reading and writing off the decoding thread; gzip is the fallback
+    rapidgzip = shutil.which('rapidgzip')
+    if rapidgzip:
+        return [rapidgzip, '-d', '-c', '-P', str(threads), src]
+    pigz = shutil.which('pigz')
+    if pigz:
+        return [pigz, '-dc', '-p', str(threads), src]
+    return ['gzip', '-dc', src]
+
+def decompress_file(src, dest, threads=1):
+    cmd = decompress_command(src, threads)
+    logging.info(f'Running command: {shlex.join(cmd)} > {dest}')
+    with open(dest, 'wb') as f:
+        try:
+            result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=f)
+        except OSError as e:
+            logging.error(f'Could not run {cmd[0]}: {e}')
+            sys.exit(f'Error: Could not run {cmd[0]}: {e}')
+    if result.returncode != 0:
+        logging.error(f'Command failed: {shlex.join(cmd)}')
+        sys.exit(f'Error: Could not decompress {src}.')
+    # Keep the source's timestamps, as gunzip does, so FastQC reports of the
+    # original file still count as up to date for the staged copy
+    st = os.stat(src)
+    os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+def stage_inputs(paired_files, scratch_dir, threads=1):
+    """
+    Decompress the paired input reads once into a fresh directory under
+    scratch_dir (e.g. /dev/shm), so FastQC and Trimmomatic read plain FASTQ
+    instead of each gunzipping the same files.
+
+    Returns the paired files pointing at the staged copies and the staging
+    directory, or the original files and None if there is not enough room.
+    """
+    gz_files = [f for files in paired_files.values() for f in files.values() if f.endswith('.gz')]
+    if not gz_files:
+        return paired_files, None
+    # FASTQ typically compresses about 4x; leave headroom on top of that
+    needed = 5 * sum(os.path.getsize(f) for f in gz_files)
+    free = shutil.disk_usage(scratch_dir).free
+    if free < needed:
+        logging.warning(f'Not enough space in {scratch_dir} to stage inputs '
+                        f'({free} bytes free, about {needed} needed); reading compressed files directly.')
+        return paired_files, None
+
+    staged_dir = tempfile.mkdtemp(prefix='holmgenome_', dir=scratch_dir)
+    staged = {}
+    tasks = []
     for sample, files in paired_files.items():
-        if 'R1' in files and 'R2' in files:
-            input_file1 = files['R1']
-            input_file2 = files['R2']
-            base_output_path = os.path.join(args.output_dir, 'Trim_data', sample)
-            os.makedirs(base_output_path, exist_ok=True)
-
-            if args.bbduk:
-                params = {
-                    'input_file1': input_file1,
-                    'input_file2': input_file2,
-                    'output_file1': os.path.join(base_output_path, f'{sample}_R1_trimmed.fastq.gz'),
-                    'output_file2': os.path.join(base_output_path, f'{sample}_R2_trimmed.fastq.gz'),
-                    'bbduk_path': args.bbduk_path if args.bbduk_path else 'bbduk.sh',
-                    'adapters_path': args.adapters_path,
-                    'ktrim': args.ktrim,
-                    'k': args.k,
-                    'mink': args.mink,
-                    'hdist': args.hdist,
-                    'tpe': args.tpe,
-                    'tbo': args.tbo,
-                    'qtrim': args.qtrim,
-                    'trimq': args.trimq,
-                    'minlen': args.minlen
-                }
-                run_bbduk(params)
+        staged[sample] = {}
+        for read, src in files.items():
+            if src.endswith('.gz'):
+                dest = os.path.join(staged_dir, os.path.basename(src)[:-len('.gz')])
+                tasks.append((src, dest))
+                staged[sample][read] = dest
             else:
-                params = {
-                    'input_file1': input_file1,
-                    'input_file2': input_file2,
-                    'output_file1_paired': os.path.join(base_output_path, f"{sample}_R1_paired.fastq.gz"),
-                    'output_file1_unpaired': os.path.join(base_output_path, f"{sample}_R1_unpaired.fastq.gz"),
-                    'output_file2_paired': os.path.join(base_output_path, f"{sample}_R2_paired.fastq.gz"),
-                    'output_file2_unpaired': os.path.join(base_output_path, f"{sample}_R2_unpaired.fastq.gz"),
-                    'trimmomatic_path': args.trimmomatic_path,
-                    'adapters_path': args.adapters_path,
-                    'illuminaclip': args.illuminaclip,
-                    'slidingwindow': args.slidingwindow,
-                    'leading': args.leading,
-                    'trailing': args.trailing,
-                    'crop': args.crop,
-                    'headcrop': args.headcrop,
-                    'minlen': args.minlen
-                }
-                run_trimmomatic(params)
+                staged[sample][read] = src
+    per_file_threads = max(1, threads // len(tasks))
+    # A failed decompression exits and Ctrl-C interrupts; either way the
+    # partly filled directory would otherwise hold RAM in /dev/shm
+    try:
+        with ThreadPoolExecutor(max_workers=min(len(tasks), threads)) as executor:
+            futures = [executor.submit(decompress_file, src, dest, per_file_threads) for src, dest in tasks]
+            for future in futures:
+                future.result()
+    except BaseException:
+        shutil.rmtree(staged_dir, ignore_errors=True)
+        raise
+    logging.info(f'Staged {len(tasks)} input files in {staged_dir}')
+    return staged, staged_dir
+
+def trim_settings(args):
+    # Everything besides the reads that changes the trimmed output
+    if args.fastp:
+        return ['fastp', args.adapters_path, args.minlen]
+    if args.bbduk:
+        return ['bbduk', args.adapters_path, args.ktrim, args.k, args.mink, args.hdist, args.tpe, args.tbo,
+                args.qtrim, args.trimq, args.minlen]
+    return ['trimmomatic', args.adapters_path, args.illuminaclip, args.slidingwindow, args.leading, args.trailing,
+            args.crop, args.headcrop, args.minlen]
+
+def trim_sample(sample, files, sources, args, settings, threads):
+    input_file1 = files['R1']
+    input_file2 = files['R2']
+    base_output_path = os.path.join(args.output_dir, 'Trim_data', sample)
+    os.makedirs(base_output_path, exist_ok=True)
+    if not args.force and is_done(base_output_path, 'trim', sources, settings):
+        return
+
+    if args.fastp:
+        params = {
+            'sample': sample,
+            'input_file1': input_file1,
+            'input_file2': input_file2,
+            'output_file1': os.path.join(base_output_path, f'{sample}_R1_paired.fastq.gz'),
+            'output_file2': os.path.join(base_output_path, f'{sample}_R2_paired.fastq.gz'),
+            'fastp_path': args.fastp_path,
+            'threads': threads,
+            'adapters_path': args.adapters_path,
+            'minlen': args.minlen
+        }
+        run_fastp(params)
+    elif args.bbduk:
+        params = {
+            'input_file1': input_file1,
+            'input_file2': input_file2,
+            # Same names as the Trimmomatic paired output, which is what
+            # the assembly stage looks for
+            'output_file1': os.path.join(base_output_path, f'{sample}_R1_paired.fastq.gz'),
+            'output_file2': os.path.join(base_output_path, f'{sample}_R2_paired.fastq.gz'),
+            'bbduk_path': args.bbduk_path if args.bbduk_path else 'bbduk.sh',
+            'java_heap': args.java_heap,
+            'threads': threads,
+            'adapters_path': args.adapters_path,
+            'ktrim': args.ktrim,
+            'k': args.k,
+            'mink': args.mink,
+            'hdist': args.hdist,
+            'tpe': args.tpe,
+            'tbo': args.tbo,
+            'qtrim': args.qtrim,
+            'trimq': args.trimq,
+            'minlen': args.minlen
+        }
+        run_bbduk(params)
+    else:
+        params = {
+            'input_file1': input_file1,
+            'input_file2': input_file2,
+            'output_file1_paired': os.path.join(base_output_path, f"{sample}_R1_paired.fastq.gz"),
+            'output_file1_unpaired': os.path.join(base_output_path, f"{sample}_R1_unpaired.fastq.gz"),
+            'output_file2_paired': os.path.join(base_output_path, f"{sample}_R2_paired.fastq.gz"),
+            'output_file2_unpaired': os.path.join(base_output_path, f"{sample}_R2_unpaired.fastq.gz"),
+            'trimmomatic_path': args.trimmomatic_path,
+            'java_heap': args.java_heap,
+            'threads': threads,
+            'adapters_path': args.adapters_path,
+            'illuminaclip': args.illuminaclip,
+            'slidingwindow': args.slidingwindow,
+            'leading': args.leading,
+            'trailing': args.trailing,
+            'crop': args.crop,
+            'headcrop': args.headcrop,
+            'minlen': args.minlen
+        }
+        run_trimmomatic(params)
+    mark_done(base_output_path, 'trim', sources, settings)
+
+def try_trim_sample(sample, *args):
+    # Returns the sample name if trimming failed, so the rest still run
+    try:
+        trim_sample(sample, *args)
+    except SubprocessError as e:
+        logging.error(f'Trimming failed for sample {sample}: {e}')
+        return sample
+    return None
+
+def process_samples(args, paired_files, source_files=None, cpus=None):
+    """
+    Trim every complete pair of reads within cpus CPUs (default: --threads)
+    and return the names of the samples that failed. A failure does not stop
+    the other samples.
+    """
+    # source_files are the original reads when paired_files point at staged
+    # copies; the checkpoint is keyed on the originals so it survives restaging
+    source_files = source_files or paired_files
+    settings = trim_settings(args)
+    tasks = []
+    for sample, files in paired_files.items():
+        if 'R1' in files and 'R2' in files:
+            sources = [source_files[sample]['R1'], source_files[sample]['R2']]
+            tasks.append((sample, files, sources))
         else:
             logging.warning(f'Missing pair for sample {sample}')
+    if not tasks:
+        return []
+    # Trimmers stop scaling after a few threads, so by default samples are
+    # trimmed side by side with about four threads each
+    cpus = cpus or args.threads
+    jobs = args.jobs or max(1, min(len(tasks), cpus // 4))
+    threads = max(1, cpus // jobs)
+    logging.info(f'Trimming {len(tasks)} samples, {jobs} at a time with {threads} threads each')
+    results = run_parallel(try_trim_sample, [(sample, files, sources, args, settings, threads)
+                                             for sample, files, sources in tasks], jobs)
+    failed = [sample for sample in results if sample]
+    if failed:
+        logging.error(f'Trimming failed for {len(failed)} of {len(tasks)} samples: {", ".join(failed)}')
+    return failed
 
 def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_dir', required=True, help='Path to the input directory')
     parser.add_argument('--output_dir', required=True, help='Path to the output directory')
-    parser.add_argument('--trimmomatic_path', required=True, help='Path to the Trimmomatic jar file')
+    parser.add_argument('--trimmomatic_path', default=None, help='Path to the Trimmomatic jar file or executable (required unless --bbduk or --fastp)')
+    parser.add_argument('--threads', default=os.cpu_count() or 1, type=int, help='Number of threads for trimming and FastQC (default: all CPUs)')
+    parser.add_argument('--jobs', default=None, type=int,
+                        help='Number of samples to trim at once; --threads is split between them (default: --threads / 4)')
+    parser.add_argument('--java_heap', default=None, help='Maximum Java heap for Trimmomatic or BBDuk, e.g. 4g (default: JVM default)')
     parser.add_argument('--adapters_path', required=True, help='Path to the adapters file')
     parser.add_argument('--illuminaclip', default='2:30:10', help='ILLUMINACLIP option for Trimmomatic')
     parser.add_argument('--slidingwindow', default='4:15', help='SLIDINGWINDOW option for Trimmomatic')
@@ -169,30 +505,89 @@ def main(argv=None):
     parser.add_argument('--tbo', default='t', help='TBO option for BBDuk')
     parser.add_argument('--qtrim', default='rl', help='QTRIM option for BBDuk')
     parser.add_argument('--trimq', default='10', help='TRIMQ option for BBDuk')
+    parser.add_argument('--fastp', action='store_true', help='Use fastp for processing')
+    parser.add_argument('--fastp_path', default='fastp', help='Path to the fastp executable')
     parser.add_argument('--fastqc_path', default='fastqc', help='Path to the FastQC executable')
-    parser.add_argument('--skip_trim', action='store_true', help='Skip trimming and just run FastQC on input_dir')
+    parser.add_argument('--mode', choices=['raw', 'trim', 'both'], default='both',
+                        help='raw: trim and run FastQC on the raw reads; trim: only run FastQC on input_dir '
+                             '(already trimmed reads); both: trim and run FastQC on raw and trimmed reads')
+    parser.add_argument('--skip_trim', action='store_true', help='Skip trimming and just run FastQC on input_dir (same as --mode trim)')
+    parser.add_argument('--force', action='store_true', help='Re-trim every sample and re-run FastQC on every file, even if already done with the same reads and options')
+    parser.add_argument('--scratch_dir', default=None,
+                        help='Fast scratch directory (e.g. /dev/shm) to decompress the raw reads into once before '
+                             'FastQC and trimming; removed afterwards')
 
     args = parser.parse_args(argv)
+    if args.mode != 'trim' and not args.skip_trim and not args.bbduk and not args.fastp and not args.trimmomatic_path:
+        parser.error('--trimmomatic_path is required unless --bbduk or --fastp is given')
+    if args.bbduk and args.fastp:
+        parser.error('--bbduk and --fastp are mutually exclusive')
+
+    tools = [args.fastqc_path]
+    if args.mode != 'trim' and not args.skip_trim:
+        if args.fastp:
+            tools.append(args.fastp_path)
+        elif args.bbduk:
+            tools.append(args.bbduk_path or 'bbduk.sh')
+        else:
+            trimmomatic = trimmomatic_command(args.trimmomatic_path)
+            tools.append(trimmomatic[0])
+            if trimmomatic[-1].endswith('.jar') and not os.path.isfile(trimmomatic[-1]):
+                parser.error(f'Trimmomatic JAR not found: {trimmomatic[-1]}')
+    require_tools(parser, tools)
 
     setup_logging()
     setup_directories(args.output_dir)
 
     if args.skip_trim:
-        trimmed_data_qc_dir = os.path.join(args.output_dir, 'QC', 'Trim')
-        run_fastqc(args.fastqc_path, args.input_dir, trimmed_data_qc_dir)
-    else:
-        paired_files = pair_fastq_files(args.input_dir, args.suffix1, args.suffix2)
-        process_samples(args, paired_files)
+        args.mode = 'trim'
+
+    raw_data_qc_dir = os.path.join(args.output_dir, 'QC', 'raw_data')
+    trimmed_data_qc_dir = os.path.join(args.output_dir, 'QC', 'Trim')
+
+    # A failed FastQC run is not specific to one sample, so it ends the stage
+    try:
+        if args.mode == 'trim':
+            run_fastqc(args.fastqc_path, args.input_dir, trimmed_data_qc_dir, force=args.force, threads=args.threads)
+        else:
+            # The input tree is listed once, for both pairing and raw FastQC
+            input_fastqs = find_fastq_files(args.input_dir)
+            source_files = pair_fastq_files(args.input_dir, args.suffix1, args.suffix2, input_fastqs)
+            paired_files = source_files
+            raw_files = [path for _, path in input_fastqs]
+            staged_dir = None
+            if args.scratch_dir:
+                paired_files, staged_dir = stage_inputs(source_files, args.scratch_dir, args.threads)
+                staged = {source_files[sample][read]: path
+                          for sample, files in paired_files.items() for read, path in files.items()}
+                raw_files = [staged.get(path, path) for path in raw_files]
 
-        # After trimming, run fastqc on raw_data and trimmed_data
-        raw_data_qc_dir = os.path.join(args.output_dir, 'QC', 'raw_data')
-        trimmed_data_qc_dir = os.path.join(args.output_dir, 'QC', 'Trim')
+            # FastQC on raw data does not depend on trimming, so run it alongside
+            # the trimming step on a small share of the CPUs; FastQC on trimmed
+            # data has to wait for it.
+            fastqc_threads, trim_threads = split_cpus(args.threads)
+            try:
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    raw_qc = executor.submit(run_fastqc, args.fastqc_path, args.input_dir, raw_data_qc_dir, raw_files,
+                                             args.force, fastqc_threads)
+                    trim = executor.submit(process_samples, args, paired_files, source_files, trim_threads)
+                    failed = trim.result()
+                    raw_qc.result()
+            finally:
+                if staged_dir:
+                    shutil.rmtree(staged_dir, ignore_errors=True)
 
-        # FastQC on raw data
-        run_fastqc(args.fastqc_path, args.input_dir, raw_data_qc_dir)
+            # The other samples are trimmed, but stop before FastQC reads the
+            # partial output of the failed ones
+            if failed:
+                sys.exit(f'Error: Trimming failed for {", ".join(failed)}. '
+                         f'Check the logs in their Trim_data directories.')
 
-        trimmed_data_path = os.path.join(args.output_dir, 'Trim_data')
-        run_fastqc(args.fastqc_path, trimmed_data_path, trimmed_data_qc_dir)
+            if args.mode == 'both':
+                trimmed_data_path = os.path.join(args.output_dir, 'Trim_data')
+                run_fastqc(args.fastqc_path, trimmed_data_path, trimmed_data_qc_dir, force=args.force, threads=args.threads)
+    except SubprocessError as e:
+        sys.exit(f'Error: {e}')
 
     return
 